@@ -1,15 +1,16 @@
 """ This Cloud Function leverages the Looker Python SDK to automate Looker content cleanup.
 
 It accomplishes the following tasks:
-1. Get unused content and deleted content data from a Looker System Activity query in JSON.
+1. Get unused content and deleted content data from Looker System Activity queries in CSV.
 2. Archive (soft delete) dashboards and Looks which were last accessed more than 90 days ago.
 3. Permanently (hard) delete dashboards and Looks which have been archived for more than 90 days.
-4. Send an email notification using Looker's scheduler of all the content that was archived & permanently deleted.
+4. Send a single email notification using Looker's scheduler of all the content that was archived & permanently deleted.
 
 Search `todo` to:
-- Update GCP_PROJET_ID and GCS_BUCKET_NAME to enable backing up dashboards to GCS before permanent deletion.
+- Update GCP_PROJET_ID and GCS_BUCKET_NAME to enable backing up dashboards to GCS before permanent deletion and caching query IDs and results between runs.
 - Update DAYS_BEFORE_SOFT_DELETE (# of days content is unused before archival) and DAYS_BEFORE_HARD_DELETE (# of days in trash before permanent deletion).
 - Update NOTIFICATION_EMAIL_ADDRESS (email address for content deletion notification).
+- Update MAX_CONCURRENT_DELETES (# of dashboards/Looks deleted in parallel) and API_CONCURRENCY_LIMIT (# of Looker API calls in flight at once).
 - Toggle dry run of automation off/on.
 
 Last modified: March 2023
@@ -21,7 +22,17 @@ from looker_sdk import error
 from google.cloud import storage
 from google.cloud import exceptions
 import json
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+import copy
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import random
+import threading
+import time
+from datetime import datetime, timedelta
 
 
 # todo: enter desired configuration
@@ -30,167 +41,503 @@ DAYS_BEFORE_SOFT_DELETE = 90
 DAYS_BEFORE_HARD_DELETE = 90
 NOTIFICATION_EMAIL_ADDRESS = "email@address.com"
 GCS_BUCKET_NAME = ""
+MAX_CONCURRENT_DELETES = 8
+API_CONCURRENCY_LIMIT = 4
+API_MAX_ATTEMPTS = 5
+QUERY_ID_CACHE_TTL_DAYS = 7
+SEARCH_BATCH_SIZE = 100
+PROCESSED_FLUSH_INTERVAL = 100
+CACHE_FOLDER_NAME = "looker-cleanup-cache"
 
 
 # Initialize Looker SDK & Google Cloud Storage
 sdk = looker_sdk.init40()
-storage_client = storage.Client(project=GCP_PROJECT_ID)
+thread_local = threading.local()
+api_semaphore = threading.BoundedSemaphore(value=API_CONCURRENCY_LIMIT)
+worker_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DELETES)
+
+
+# Fields (in column order) selected by the unused and deleted content queries that drive deletions. Rows from the unused content query stop before CONTENT_TITLE.
+CONTENT_ID_FIELDS = [
+    "content_usage.content_type",
+    "dashboard.id",
+    "look.id",
+    "content_usage.content_title"
+]
+CONTENT_TYPE, DASHBOARD_ID, LOOK_ID, CONTENT_TITLE = range(len(CONTENT_ID_FIELDS))
+
+
+# Query and schedule bodies are built once per instance, only the `days` filters, email address and message change per invocation.
+UNUSED_CONTENT_QUERY_TEMPLATE = models40.WriteQuery(
+    model="system__activity",
+    view="content_usage",
+    fields=CONTENT_ID_FIELDS[:CONTENT_TITLE],
+    pivots=None,
+    fill_fields=None,
+    filters={
+        "content_usage.content_type": "dashboard,look",
+        "_dashboard_linked_looks.is_used_on_dashboard": "No",
+        "look.public": "No"
+    },
+    filter_expression="if(is_null(${dashboard.deleted_date}) = no OR is_null(${look.deleted_date}) = no,no,yes)",
+    sorts=["content_usage.last_accessed_date"],
+    limit="50000"
+)
+DELETED_CONTENT_QUERY_TEMPLATE = models40.WriteQuery(
+    model="system__activity",
+    view="content_usage",
+    fields=CONTENT_ID_FIELDS,
+    dynamic_fields='[{"category":"dimension",\
+        "expression":"diff_days(coalesce(${dashboard.deleted_date},${look.deleted_date}), now())",\
+        "label":"Days Since Moved to Trash",\
+        "value_format":null,\
+        "value_format_name":null,\
+        "dimension":"days_since_moved_to_trash",\
+        "_kind_hint":"dimension",\
+        "_type_hint":"number"}]',
+    pivots=None,
+    fill_fields=None,
+    filters={
+        "content_usage.content_type": "dashboard,look"
+    },
+    filter_expression="if(is_null(${dashboard.deleted_date}) = no OR is_null(${look.deleted_date}) = no,yes,no)",
+    sorts=["content_usage.last_accessed_date"],
+    limit="50000"
+)
+NOTIFICATION_QUERY_TEMPLATE = models40.WriteQuery(
+    model="system__activity",
+    view="content_usage",
+    fields=[
+        "cleanup_action",
+        "content_usage.content_title",
+        "content_usage.content_type",
+        "content_usage.last_accessed_date",
+        "dashboard.deleted_date",
+        "dashboard.id",
+        "look.deleted_date",
+        "look.id"
+    ],
+    dynamic_fields=json.dumps([{
+        "category": "dimension",
+        "expression": 'if(is_null(coalesce(${dashboard.deleted_date},${look.deleted_date})), "Archived (soft deleted)", "Permanently (hard) deleted")',
+        "label": "Cleanup Action",
+        "value_format": None,
+        "value_format_name": None,
+        "dimension": "cleanup_action",
+        "_kind_hint": "dimension",
+        "_type_hint": "string"
+    }]),
+    pivots=None,
+    fill_fields=None,
+    filters={
+        "content_usage.content_type": "dashboard,look"
+    },
+    sorts=["cleanup_action", "content_usage.last_accessed_date"],
+    limit="50000"
+)
+NOTIFICATION_DESTINATION_TEMPLATE = models40.ScheduledPlanDestination(
+    format="csv",
+    type="email",
+    apply_formatting=False,
+    apply_vis=False
+)
 
 
 def main(request):
-    # Run a System Activity query to get unused content in past 90 (default) days, archive (soft delete) the content, then send an email with a list of the content.
-    unused_content_query_id = get_unused_content_query_id(
-        DAYS_BEFORE_SOFT_DELETE)
-    unused_content = get_unused_content(unused_content_query_id)
-    unused_dashboard_ids = get_dashboard_ids(unused_content)
-    unused_look_ids = get_look_ids(unused_content)
+    # Run System Activity queries to get unused content in past 90 (default) days and content deleted 90+ (default) days ago.
+    # Both queries are independent so they run at the same time, along with creating and caching the results of the query used for the email.
+    notification_query_id_future = worker_pool.submit(
+        get_notification_query_id,
+        DAYS_BEFORE_SOFT_DELETE,
+        DAYS_BEFORE_HARD_DELETE
+    )
+    unused_content_future = worker_pool.submit(
+        get_unused_content_inline, DAYS_BEFORE_SOFT_DELETE)
+    deleted_content_future = worker_pool.submit(
+        get_deleted_content_inline, DAYS_BEFORE_HARD_DELETE)
+    wait([
+        notification_query_id_future,
+        unused_content_future,
+        deleted_content_future
+    ])
+
+    # Archive (soft delete) the unused content.
+    unused_content = unused_content_future.result()
+    unused_dashboard_ids, unused_look_ids = split_ids(unused_content)
+    soft_deleted_dashboards = ProcessedContent("soft-dashboards")
+    soft_deleted_looks = ProcessedContent("soft-looks")
+
+    # Skip content that's already in the Trash folder (e.g. trashed by a user after the query ran) or was already soft deleted by an earlier run today, rather than re-updating it.
+    trashed_dashboard_ids_future = worker_pool.submit(
+        get_trashed_dashboard_ids,
+        [dashboard_id for dashboard_id, _ in unused_dashboard_ids]
+    )
+    trashed_look_ids_future = worker_pool.submit(
+        get_trashed_look_ids, unused_look_ids)
+    trashed_dashboard_ids = trashed_dashboard_ids_future.result()
+    trashed_look_ids = trashed_look_ids_future.result()
+    unused_dashboard_ids = [
+        (dashboard_id, dashboard_title)
+        for dashboard_id, dashboard_title in unused_dashboard_ids
+        if dashboard_id not in trashed_dashboard_ids
+        and dashboard_id not in soft_deleted_dashboards.ids
+    ]
+    unused_look_ids = [
+        look_id for look_id in unused_look_ids
+        if look_id not in trashed_look_ids
+        and look_id not in soft_deleted_looks.ids
+    ]
 
-    for dashboard_id, _ in unused_dashboard_ids:
-        soft_delete_dashboard(dashboard_id)
+    # Processed IDs are flushed even if a delete fails, so a retry skips the content that was already deleted.
+    try:
+        wait_all(
+            submit_all(
+                soft_delete_dashboard,
+                [dashboard_id for dashboard_id, _ in unused_dashboard_ids],
+                processed=soft_deleted_dashboards
+            ) + submit_all(
+                soft_delete_look,
+                unused_look_ids,
+                processed=soft_deleted_looks
+            )
+        )
+    finally:
+        soft_deleted_dashboards.flush()
+        soft_deleted_looks.flush()
+
+    # Permenantly (hard) delete the deleted content.
+    deleted_content = deleted_content_future.result()
+    deleted_dashboard_ids, deleted_look_ids = split_ids(deleted_content)
+    hard_deleted_dashboards = ProcessedContent("hard-dashboards")
+    hard_deleted_looks = ProcessedContent("hard-looks")
+
+    # Skip content that was already hard deleted by an earlier run today.
+    deleted_dashboard_ids = [
+        (dashboard_id, dashboard_title)
+        for dashboard_id, dashboard_title in deleted_dashboard_ids
+        if dashboard_id not in hard_deleted_dashboards.ids
+    ]
+    deleted_look_ids = [
+        look_id for look_id in deleted_look_ids
+        if look_id not in hard_deleted_looks.ids
+    ]
 
-    for look_id in unused_look_ids:
-        soft_delete_look(look_id)
+    try:
+        wait_all(
+            submit_all(
+                backup_and_hard_delete_dashboard,
+                [dashboard_id for dashboard_id, _ in deleted_dashboard_ids],
+                [dashboard_title for _, dashboard_title in deleted_dashboard_ids],
+                processed=hard_deleted_dashboards
+            ) + submit_all(
+                hard_delete_look,
+                deleted_look_ids,
+                processed=hard_deleted_looks
+            )
+        )
+    finally:
+        hard_deleted_dashboards.flush()
+        hard_deleted_looks.flush()
 
+    # Send an email with a list of both the archived and permanently deleted content.
     send_content_notification(
-        unused_content_query_id,
-        "soft",
+        notification_query_id_future.result(),
         NOTIFICATION_EMAIL_ADDRESS
     )
 
-    # Run a System Activity query to get content deleted 90+ (default) days ago, permenantly (hard) delete the content, then send an email with a list of the content.
-    deleted_content_query_id = get_deleted_content_query_id(
-        DAYS_BEFORE_HARD_DELETE)
-    deleted_content = get_deleted_content(deleted_content_query_id)
-    deleted_dashboard_ids = get_dashboard_ids(deleted_content)
-    deleted_look_ids = get_look_ids(deleted_content)
+    return "Successfully ran soft delete and hard delete content automation."
 
-    for dashboard_id, dashboard_title in deleted_dashboard_ids:
-        # todo: comment out backup_dashboard_lookml to disable backing up dashboard LookML to GCS feature before hard deleting the dashboard.
-        backup_dashboard_lookml(dashboard_id, dashboard_title)
-        hard_delete_dashboard(dashboard_id)
 
-    for look_id in deleted_look_ids:
-        hard_delete_look(look_id)
+def get_sdk():
+    """ Get the Looker SDK for the current thread. Each worker thread initializes its own SDK since the SDK's HTTP session isn't guaranteed to be thread-safe. """
+    if not hasattr(thread_local, "sdk"):
+        thread_local.sdk = looker_sdk.init40()
+    return thread_local.sdk
 
-    send_content_notification(
-        deleted_content_query_id,
-        "hard",
-        NOTIFICATION_EMAIL_ADDRESS
-    )
 
-    return "Successfully ran soft delete and hard delete content automation."
+def get_storage_client():
+    """ Get the Google Cloud Storage client for the current thread. Like the SDK, each thread creates its own client since storage.Client isn't guaranteed to be thread-safe. """
+    if not hasattr(thread_local, "storage_client"):
+        thread_local.storage_client = storage.Client(project=GCP_PROJECT_ID)
+    return thread_local.storage_client
 
 
-def get_unused_content_query_id(days: int):
-    """ Get a re-useable query ID for a System Activity query which returns all content that hasn't been used in at least 90 (default) days. 
-    This query ID can be used to run the query and send a schedule with the query's results. 
+def submit_all(func, *iterables, processed=None):
+    """ Submit func for each item of the given iterables to the shared worker pool without waiting for the results.
+    The pool lives for the lifetime of the function instance, so its threads (and each thread's logged in SDK) are re-used across batches and warm invocations.
+    If processed is given, the first argument of each successful call is recorded in it before the call's future completes.
     """
-    unused_content_query = models40.WriteQuery(
-        model="system__activity",
-        view="content_usage",
-        fields=[
-            "content_usage.content_title",
-            "content_usage.content_type",
-            "content_usage.last_accessed_date",
-            "dashboard.id",
-            "look.id"
-        ],
-        pivots=None,
-        fill_fields=None,
-        filters={
-            "content_usage.days_since_last_accessed": f">{days}",
-            "content_usage.content_type": "dashboard,look",
-            "_dashboard_linked_looks.is_used_on_dashboard": "No",
-            "look.public": "No"
-        },
-        filter_expression="if(is_null(${dashboard.deleted_date}) = no OR is_null(${look.deleted_date}) = no,no,yes)",
-        sorts=["content_usage.last_accessed_date"],
-        limit="50000"
-    )
-    unused_content_query = sdk.create_query(
-        body=unused_content_query
-    )
-    return unused_content_query.id
+    if processed is not None:
+        func = functools.partial(call_and_record, func, processed)
+    return [worker_pool.submit(func, *args) for args in zip(*iterables)]
 
 
-def get_unused_content(query_id: str):
-    """ Run a query against System Activity to get a list of unused content. """
-    unused_content = json.loads(sdk.run_query(
-        query_id=query_id,
-        result_format="json",
-        cache=True
-    ))
+def call_and_record(func, processed, *args):
+    """ Call func, recording its first argument (the content ID) in processed if it returns True. """
+    succeeded = func(*args)
+    if succeeded:
+        processed.record(args[0])
+    return succeeded
+
+
+def wait_all(futures: list):
+    """ Wait for all of the given futures to finish, then re-raise the first exception raised by any of them. """
+    wait(futures)
+    return [future.result() for future in futures]
 
-    return unused_content
+
+def call_looker_api(method, *args, **kwargs):
+    """ Call a Looker SDK method with at most API_CONCURRENCY_LIMIT calls in flight, retrying with exponential backoff if the Looker API rate limits the request. """
+    for attempt in range(API_MAX_ATTEMPTS):
+        try:
+            with api_semaphore:
+                return method(*args, **kwargs)
+        except error.SDKError as e:
+            if not is_rate_limited(e) or attempt == API_MAX_ATTEMPTS - 1:
+                raise
+            time.sleep(min(60, (2 ** attempt) + random.random()))
+
+
+def is_rate_limited(e: error.SDKError):
+    """ Check if an SDK error is an HTTP 429 (Too Many Requests) response from the Looker API. """
+    return "/429/" in (e.documentation_url or "") or "too many requests" in str(e.message).lower()
+
+
+def get_unused_content_query(days: int):
+    """ Build a System Activity query which returns all content that hasn't been used in at least 90 (default) days. """
+    unused_content_query = copy.copy(UNUSED_CONTENT_QUERY_TEMPLATE)
+    unused_content_query.filters = {
+        **UNUSED_CONTENT_QUERY_TEMPLATE.filters,
+        "content_usage.days_since_last_accessed": f">{days}"
+    }
+    return unused_content_query
 
 
-def get_deleted_content_query_id(days: int):
-    """ Get a re-usable query ID for a System Activity query which returns all content that's been soft deleted for 90+ (default) days. 
-    This query ID can be used to run the query and send a schedule with the query's results. 
+def get_notification_query(soft_days: int, hard_days: int):
+    """ Build a System Activity query which returns both the content archived for being unused for soft_days and the content permanently deleted after hard_days in the Trash folder, so both are sent in a single email.
+    The Cleanup Action column says which of the two happened to each piece of content.
     """
-    deleted_query = models40.WriteQuery(
-        model="system__activity",
-        view="content_usage",
-        fields=[
-            "content_usage.content_title",
-            "content_usage.content_type",
-            "content_usage.last_accessed_date",
-            "dashboard.deleted_date",
-            "dashboard.id",
-            "look.deleted_date",
-            "look.id"
-        ],
-        dynamic_fields='[{"category":"dimension",\
-            "expression":"diff_days(coalesce(${dashboard.deleted_date},${look.deleted_date}), now())",\
-            "label":"Days Since Moved to Trash",\
-            "value_format":null,\
-            "value_format_name":null,\
-            "dimension":"days_since_moved_to_trash",\
-            "_kind_hint":"dimension",\
-            "_type_hint":"number"}]',
-        pivots=None,
-        fill_fields=None,
-        filters={
-            "content_usage.content_type": "dashboard,look",
-            "days_since_moved_to_trash": f">{days}"
-        },
-        filter_expression="if(is_null(${dashboard.deleted_date}) = no OR is_null(${look.deleted_date}) = no,yes,no)",
-        sorts=["content_usage.last_accessed_date"],
-        limit="50000"
+    notification_query = copy.copy(NOTIFICATION_QUERY_TEMPLATE)
+    notification_query.filter_expression = (
+        "(is_null(coalesce(${dashboard.deleted_date},${look.deleted_date}))"
+        f" AND ${{content_usage.days_since_last_accessed}} > {soft_days}"
+        " AND ${_dashboard_linked_looks.is_used_on_dashboard} = no"
+        " AND ${look.public} = no)"
+        " OR (NOT is_null(coalesce(${dashboard.deleted_date},${look.deleted_date}))"
+        f" AND diff_days(coalesce(${{dashboard.deleted_date}},${{look.deleted_date}}), now()) > {hard_days})"
     )
-    trashed_content_query = sdk.create_query(
-        body=deleted_query
-    )
-    return trashed_content_query.id
+    return notification_query
 
 
-def get_deleted_content(query_id: str):
-    """ Run a query against System Activity to get a list of content soft deleted for 90+ (default) days. """
-    unused_content = json.loads(sdk.run_query(
+def get_notification_query_id(soft_days: int, hard_days: int):
+    """ Get a re-useable query ID for the notification query, used to send a schedule with the query's results.
+    The query is run with cache=True before any content is deleted, so the email (which is sent after the deletes) uses the cached results. Otherwise archived content would no longer match the query and permanently deleted content would no longer exist.
+    """
+    query_id = get_cached_query_id(get_notification_query(soft_days, hard_days))
+    call_looker_api(
+        get_sdk().run_query,
         query_id=query_id,
-        result_format="json",
+        result_format="csv",
         cache=True
-    ))
+    )
+    return query_id
+
+
+def get_unused_content_inline(days: int):
+    """ Run an inline query against System Activity to get the unused content rows, without creating a query ID first. """
+    unused_content_query = get_unused_content_query(days)
+    unused_content = parse_content_rows(run_content_query(unused_content_query))
 
     return unused_content
 
 
-def send_content_notification(query_id: str, delete_type: str, address: str):
-    """ Send an email notification to the given email address(es) about the content that was soft/hard deleted on the given date.
+def get_deleted_content_query(days: int):
+    """ Build a System Activity query which returns all content that's been soft deleted for 90+ (default) days. """
+    deleted_content_query = copy.copy(DELETED_CONTENT_QUERY_TEMPLATE)
+    deleted_content_query.filters = {
+        **DELETED_CONTENT_QUERY_TEMPLATE.filters,
+        "days_since_moved_to_trash": f">{days}"
+    }
+    return deleted_content_query
+
+
+def get_deleted_content_inline(days: int):
+    """ Run an inline query against System Activity to get the rows of content soft deleted for 90+ (default) days, without creating a query ID first. """
+    deleted_content_query = get_deleted_content_query(days)
+    deleted_content = parse_content_rows(run_content_query(deleted_content_query))
+
+    return deleted_content
+
+
+def parse_content_rows(results: str):
+    """ Lazily parse CSV query results into rows, so rows are only materialized one at a time as they're consumed.
+    Columns are read by position (CONTENT_TYPE, DASHBOARD_ID, LOOK_ID, CONTENT_TITLE) since Looker's CSV header row uses field labels, so the header row is skipped.
     """
-    created_date = datetime.today().strftime('%Y-%m-%d')
+    rows = csv.reader(io.StringIO(results))
+    next(rows, None)
+    yield from rows
+
+
+def get_query_cache_key(query: models40.WriteQuery):
+    """ Get a stable hash of the parts of a query body that determine the query. """
+    query_definition = json.dumps({
+        "model": query.model,
+        "view": query.view,
+        "fields": query.fields,
+        "dynamic_fields": query.dynamic_fields,
+        "filters": query.filters,
+        "filter_expression": query.filter_expression,
+        "sorts": query.sorts,
+        "limit": query.limit
+    }, sort_keys=True).encode()
+    return hashlib.blake2b(query_definition, digest_size=16).hexdigest()
+
+
+def get_cached_query_id(query: models40.WriteQuery):
+    """ Get a query ID for the given query body. Query IDs are saved to the GCS bucket and re-used for QUERY_ID_CACHE_TTL_DAYS, so create_query is only called on a cache miss. """
+    if not GCS_BUCKET_NAME:
+        return get_sdk().create_query(body=query).id
+
+    full_path = f"{CACHE_FOLDER_NAME}/query_ids/{get_query_cache_key(query)}.json"
+    blob = get_storage_client().bucket(GCS_BUCKET_NAME).blob(full_path)
+
+    try:
+        if blob.exists():
+            cached_query = json.loads(blob.download_as_bytes())
+            created_at = datetime.fromisoformat(cached_query["created_at"])
+            if datetime.now() - created_at < timedelta(days=QUERY_ID_CACHE_TTL_DAYS):
+                return cached_query["query_id"]
+
+    except exceptions.GoogleCloudError as e:
+        print(f"Error reading cached query ID from GCS: {e}")
+
+    query_id = get_sdk().create_query(body=query).id
+
+    try:
+        blob.upload_from_string(
+            json.dumps({
+                "query_id": query_id,
+                "created_at": datetime.now().isoformat()
+            }),
+            content_type="application/json"
+        )
+
+    except exceptions.GoogleCloudError as e:
+        print(f"Error caching query ID {query_id} to GCS: {e}")
+
+    return query_id
+
+
+def cache_daily_results(func):
+    """ Cache the results of running a query in the GCS bucket (gzip compressed) for the rest of the day, so re-runs on the same day don't re-run the query. """
+    @functools.wraps(func)
+    def wrapper(query: models40.WriteQuery):
+        if not GCS_BUCKET_NAME:
+            return func(query)
+
+        created_date = datetime.today().strftime('%Y-%m-%d')
+        full_path = f"{CACHE_FOLDER_NAME}/results/{get_query_cache_key(query)}-{created_date}.csv.gz"
+        blob = get_storage_client().bucket(GCS_BUCKET_NAME).blob(full_path)
+
+        try:
+            if blob.exists():
+                return gzip.decompress(blob.download_as_bytes()).decode()
+
+        except exceptions.GoogleCloudError as e:
+            print(f"Error reading cached query results from GCS: {e}")
 
-    scheduled_plan_destination_body = models40.ScheduledPlanDestination(
-        format="csv",
-        type="email",
-        address=address,
-        message=f"List of dashboards and Looks that were {delete_type} deleted on {created_date}.\
-        Note, LookML dashboards are unaffected by this automation, the dashboard lkml file has to be deleted from its LookML project.",
+        results = func(query)
+
+        try:
+            blob.upload_from_string(
+                gzip.compress(results.encode()),
+                content_type="application/gzip"
+            )
+
+        except exceptions.GoogleCloudError as e:
+            print(f"Error caching query results to GCS: {e}")
+
+        return results
+
+    return wrapper
+
+
+@cache_daily_results
+def run_content_query(query: models40.WriteQuery):
+    """ Run an inline query against System Activity and return the unformatted CSV results. """
+    return get_sdk().run_inline_query(
+        result_format="csv",
+        body=query,
         apply_formatting=False,
-        apply_vis=False
+        cache=True
     )
-    unused_content_notification = models40.WriteScheduledPlan(
-        name=f"[Looker Automation] {delete_type.capitalize()} deleted content ({created_date}).",
+
+
+class ProcessedContent:
+    """ The IDs of content successfully soft/hard deleted today, persisted to the GCS bucket so a retried or timed out run skips content it already processed. """
+
+    def __init__(self, name: str):
+        created_date = datetime.today().strftime('%Y-%m-%d')
+        full_path = f"{CACHE_FOLDER_NAME}/processed/{created_date}-{name}.json"
+        self.path = full_path if GCS_BUCKET_NAME else None
+        self.ids = set()
+        self.unflushed_count = 0
+        self.lock = threading.Lock()
+
+        try:
+            blob = self._blob()
+            if blob and blob.exists():
+                self.ids = set(json.loads(blob.download_as_bytes()))
+
+        except exceptions.GoogleCloudError as e:
+            print(f"Error reading processed {name} from GCS: {e}")
+
+    def record(self, content_id: str):
+        """ Record a successfully deleted content ID, flushing to GCS every PROCESSED_FLUSH_INTERVAL IDs. """
+        with self.lock:
+            self.ids.add(content_id)
+            self.unflushed_count += 1
+            if self.unflushed_count >= PROCESSED_FLUSH_INTERVAL:
+                self._flush()
+
+    def flush(self):
+        """ Save any unflushed IDs to GCS. """
+        with self.lock:
+            if self.unflushed_count:
+                self._flush()
+
+    def _blob(self):
+        # Flushes can happen on any worker thread, so the blob is bound to the current thread's client.
+        if not self.path:
+            return None
+        return get_storage_client().bucket(GCS_BUCKET_NAME).blob(self.path)
+
+    def _flush(self):
+        self.unflushed_count = 0
+        blob = self._blob()
+        if not blob:
+            return
+        try:
+            blob.upload_from_string(
+                json.dumps(list(self.ids)),
+                content_type="application/json"
+            )
+
+        except exceptions.GoogleCloudError as e:
+            print(f"Error saving processed content to GCS: {e}")
+
+
+def send_content_notification(query_id: str, address: str):
+    """ Send an email notification to the given email address(es) about the content that was soft and hard deleted on the given date.
+    """
+    created_date = datetime.today().strftime('%Y-%m-%d')
+
+    scheduled_plan_destination_body = copy.copy(NOTIFICATION_DESTINATION_TEMPLATE)
+    scheduled_plan_destination_body.address = address
+    scheduled_plan_destination_body.message = f"List of dashboards and Looks that were archived (soft deleted) or permanently (hard) deleted on {created_date}, see the Cleanup Action column.\
+        Note, LookML dashboards are unaffected by this automation, the dashboard lkml file has to be deleted from its LookML project."
+    content_notification = models40.WriteScheduledPlan(
+        name=f"[Looker Automation] Soft and hard deleted content ({created_date}).",
         query_id=query_id,
         scheduled_plan_destination=[
             scheduled_plan_destination_body
@@ -199,32 +546,68 @@ def send_content_notification(query_id: str, delete_type: str, address: str):
 
     try:
         send_notification = sdk.scheduled_plan_run_once(
-            body=unused_content_notification
+            body=content_notification
         )
         return send_notification
     except Exception as e:
         print(
-            f"Error sending {delete_type} delete email notification ({created_date}): {e}")
-
-
-def get_dashboard_ids(content: list):
-    """ Get the dashboard IDs for the given content. """
-    return [
-        (str(dashboard['dashboard.id']),
-         dashboard['content_usage.content_title'])
-        for dashboard in content
-        if dashboard['content_usage.content_type'] == 'dashboard'
-        and dashboard['dashboard.id'] is not None
-    ]
+            f"Error sending delete email notification ({created_date}): {e}")
 
 
-def get_look_ids(content: list):
-    """ Get the look IDs for the given content. """
-    return [
-        str(look['look.id'])
-        for look in content
-        if look['content_usage.content_type'] == 'look'
-    ]
+def split_ids(content):
+    """ Get the dashboard IDs (with titles) and Look IDs for the given content rows in a single pass.
+    There are only two content types, so comparing them directly is cheaper than a dict lookup per row. IDs are already strings since rows are parsed from CSV.
+    """
+    dashboard_ids = []
+    look_ids = []
+    for row in content:
+        content_type = row[CONTENT_TYPE]
+        if content_type == 'dashboard':
+            if row[DASHBOARD_ID]:
+                dashboard_title = row[CONTENT_TITLE] if len(row) > CONTENT_TITLE else None
+                dashboard_ids.append((row[DASHBOARD_ID], dashboard_title))
+        elif content_type == 'look':
+            look_ids.append(row[LOOK_ID])
+    return dashboard_ids, look_ids
+
+
+def get_trashed_dashboard_ids(dashboard_ids: list):
+    """ Get the IDs of the given dashboards which are already soft deleted, searching for SEARCH_BATCH_SIZE dashboards per API call. """
+    trashed_dashboard_ids = set()
+    for i in range(0, len(dashboard_ids), SEARCH_BATCH_SIZE):
+        batch = dashboard_ids[i:i + SEARCH_BATCH_SIZE]
+        try:
+            dashboards = call_looker_api(
+                get_sdk().search_dashboards,
+                id=",".join(batch),
+                deleted="true",
+                fields="id",
+                limit=len(batch)
+            )
+            trashed_dashboard_ids.update(
+                dashboard.id for dashboard in dashboards)
+        except Exception as e:
+            print(f"Error searching for soft deleted dashboards: {e}")
+    return trashed_dashboard_ids
+
+
+def get_trashed_look_ids(look_ids: list):
+    """ Get the IDs of the given Looks which are already soft deleted, searching for SEARCH_BATCH_SIZE Looks per API call. """
+    trashed_look_ids = set()
+    for i in range(0, len(look_ids), SEARCH_BATCH_SIZE):
+        batch = look_ids[i:i + SEARCH_BATCH_SIZE]
+        try:
+            looks = call_looker_api(
+                get_sdk().search_looks,
+                id=",".join(batch),
+                deleted=True,
+                fields="id",
+                limit=len(batch)
+            )
+            trashed_look_ids.update(look.id for look in looks)
+        except Exception as e:
+            print(f"Error searching for soft deleted Looks: {e}")
+    return trashed_look_ids
 
 
 def soft_delete_dashboard(dashboard_id: str):
@@ -233,10 +616,12 @@ def soft_delete_dashboard(dashboard_id: str):
     dashboard = models40.WriteDashboard(deleted=False)
     # dashboard = models40.WriteDashboard(deleted=True)
     try:
-        sdk.update_dashboard(dashboard_id, body=dashboard)
+        call_looker_api(get_sdk().update_dashboard, dashboard_id, body=dashboard)
         print(f"Successfully soft deleted dashboard: {dashboard_id}")
+        return True
     except Exception as e:
         print(f"Error with soft deleting dashboard ({dashboard_id}): {e}")
+        return False
 
 
 def soft_delete_look(look_id: str):
@@ -245,30 +630,43 @@ def soft_delete_look(look_id: str):
     look = models40.WriteLookWithQuery(deleted=False)
     # look = models40.WriteLookWithQuery(deleted=True)
     try:
-        sdk.update_look(look_id, body=look)
+        call_looker_api(get_sdk().update_look, look_id, body=look)
         print(f"Successfully soft deleted Look: {look_id}")
+        return True
     except Exception as e:
         print(f"Error with soft deleting Look ({look_id}): {e}")
+        return False
 
 
 def hard_delete_dashboard(dashboard_id: str):
     """ Hard (permanently) delete a dashboard from the instanace. There is no undo for this kind of delete! """
     try:
         # todo: to toggle off safe mode and hard delete dashboards, uncomment the delete_dashboard() method
-        # sdk.delete_dashboard(dashboard_id)
+        # call_looker_api(get_sdk().delete_dashboard, dashboard_id)
         print(f"Successfully permanently deleted dashboard: {dashboard_id}")
+        return True
     except Exception as e:
         print(f"Error permanently deleting dashboard ({dashboard_id}): {e}")
+        return False
 
 
 def hard_delete_look(look_id: str):
     """ Hard (permanently) delete a Look from the instanace. There is no undo for this kind of delete! """
     try:
         # todo: to toggle off safe mode and hard delete Looks, uncomment the delete_look() method
-        # sdk.delete_look(look_id)
+        # call_looker_api(get_sdk().delete_look, look_id)
         print(f"Successfully permanently deleted Look: {look_id}")
+        return True
     except Exception as e:
         print(f"Error permanently deleting Look ({look_id}): {e}")
+        return False
+
+
+def backup_and_hard_delete_dashboard(dashboard_id: str, dashboard_title: str):
+    """ Back up a dashboard's LookML to GCS, then hard delete the dashboard. """
+    # todo: comment out backup_dashboard_lookml to disable backing up dashboard LookML to GCS feature before hard deleting the dashboard.
+    backup_dashboard_lookml(dashboard_id, dashboard_title)
+    return hard_delete_dashboard(dashboard_id)
 
 
 def backup_dashboard_lookml(dashboard_id: str, dashboard_title: str):
@@ -278,7 +676,7 @@ def backup_dashboard_lookml(dashboard_id: str, dashboard_title: str):
     file_name = f'{dashboard_id}-{dashboard_title}'
 
     try:
-        dashboard_lookml = sdk.dashboard_lookml(
+        dashboard_lookml = get_sdk().dashboard_lookml(
             dashboard_id=dashboard_id)['lookml']
 
     except error.SDKError as e:
@@ -288,7 +686,7 @@ def backup_dashboard_lookml(dashboard_id: str, dashboard_title: str):
 
     if dashboard_lookml:
         try:
-            bucket = storage_client.get_bucket(GCS_BUCKET_NAME)
+            bucket = get_storage_client().get_bucket(GCS_BUCKET_NAME)
             full_path = f"{folder_name}" + "/" + file_name + ".json"
             blob = bucket.blob(full_path)
             blob.upload_from_string(dashboard_lookml)